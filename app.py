@@ -1,58 +1,319 @@
-
+import atexit
+import hashlib
 import os
 import re
+import sqlite3
+import string
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
 from datetime import datetime, timedelta, timezone
-from urllib.parse import urlparse
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, send_file, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, event, inspect, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.schema import CreateIndex
+import orjson
+from cachetools import TTLCache, cached
 import qrcode
+from qrcode.constants import ERROR_CORRECT_L
 
 db = SQLAlchemy()
 
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",      # readers don't block the writer
+    "PRAGMA synchronous=NORMAL",    # safe with WAL, one fsync per checkpoint instead of per commit
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",     # ~64 MB page cache
+)
+
+@event.listens_for(Engine, "connect")
+def _tune_sqlite(dbapi_conn, _record):
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        cursor = dbapi_conn.cursor()
+        for pragma in _SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
 # --- Models ---
 class UrlMap(db.Model):
     __tablename__ = "url_map"
     id = db.Column(db.Integer, primary_key=True)
     long_url = db.Column(db.Text, nullable=False)
+    # blake2b-128 of long_url, set only on generated-code rows so each URL has one of those;
+    # custom-code rows leave it NULL and never conflict
+    long_url_hash = db.Column(db.LargeBinary(16), index=True, unique=True)
     short_code = db.Column(db.String(32), unique=True, index=True)
-    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: _now())
     hits = db.Column(db.Integer, default=0)
     last_accessed = db.Column(db.DateTime(timezone=True), nullable=True)
     expires_at = db.Column(db.DateTime(timezone=True), nullable=True)
 
     def is_expired(self) -> bool:
-        return self.expires_at is not None and datetime.now(timezone.utc) > self.expires_at
+        return _is_expired(self.expires_at)
+
+# Lets the "recent links" panel read the top rows instead of sorting the whole table
+db.Index("ix_url_map_created_desc", UrlMap.created_at.desc())
+
+class HitBucket(db.Model):
+    # Hourly click counts per short code, written by the hit flusher
+    __tablename__ = "hit_bucket"
+    code = db.Column(db.String(32), primary_key=True)
+    hour = db.Column(db.DateTime(timezone=True), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+def _url_hash(url: str) -> bytes:
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+
+def _now() -> datetime:
+    """Current UTC time; inside a request, the timestamp taken when it started."""
+    if has_request_context():
+        now = g.get("now")
+        if now is not None:
+            return now
+    return datetime.now(timezone.utc)
+
+def _as_utc(dt: datetime | None) -> datetime | None:
+    # SQLite hands back naive datetimes; everything we store is UTC
+    if dt is not None and dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def _is_expired(expires_at: datetime | None) -> bool:
+    return expires_at is not None and _now() > _as_utc(expires_at)
+
+# Built once so each request only binds :c and hits SQLAlchemy's compiled-statement cache
+_TARGET_STMT = select(UrlMap.long_url, UrlMap.expires_at).where(UrlMap.short_code == bindparam("c"))
+_RECENT_STMT = (
+    select(UrlMap.short_code, UrlMap.long_url, UrlMap.created_at)
+    .order_by(UrlMap.created_at.desc())
+    .limit(10)
+)
+_BUCKETS_STMT = (
+    select(HitBucket.hour, HitBucket.count)
+    .where(HitBucket.code == bindparam("c"))
+    .where(HitBucket.hour >= bindparam("since"))
+    .order_by(HitBucket.hour.desc())
+    .limit(168)  # cap: one week of hourly buckets
+)
+_DETAIL_STMT = select(
+    UrlMap.short_code, UrlMap.long_url, UrlMap.hits,
+    UrlMap.created_at, UrlMap.last_accessed, UrlMap.expires_at,
+).where(UrlMap.short_code == bindparam("c"))
+
+class IdCounter(db.Model):
+    # Single-row id allocator for backends without sequences (SQLite)
+    __tablename__ = "id_counter"
+    id = db.Column(db.Integer, primary_key=True)
+    n = db.Column(db.Integer, nullable=False, default=0)
+
+def _next_id() -> int:
+    """Allocate the next url_map id inside the current transaction."""
+    if db.engine.dialect.name == "postgresql":
+        return db.session.execute(text("SELECT nextval('url_map_id_seq')")).scalar_one()
+    return db.session.execute(
+        text("UPDATE id_counter SET n = n + 1 WHERE id = 1 RETURNING n")
+    ).scalar_one()
+
+def _load_target(code: str) -> tuple[str, datetime | None]:
+    """Fetch (long_url, expires_at) for a code; raises KeyError when unknown."""
+    row = db.session.execute(_TARGET_STMT, {"c": code}).first()
+    if row is None:
+        raise KeyError(code)
+    return row.long_url, _as_utc(row.expires_at)
+
+_qr_local = threading.local()
+
+def _render_qr(data: str, path: str):
+    # One QRCode per thread: reused across renders, never shared between threads
+    qr = getattr(_qr_local, "qr", None)
+    if qr is None:
+        qr = _qr_local.qr = qrcode.QRCode(error_correction=ERROR_CORRECT_L, box_size=6, border=2)
+    qr.clear()
+    qr.version = None  # clear() keeps the last fitted version, which would only ever grow
+    qr.add_data(data)
+    qr.make(fit=True)
+    qr.make_image().save(path, "PNG", compress_level=1)
+
+_MIGRATION_LOCK_ID = 0x7079736F  # arbitrary pg_advisory_xact_lock key for schema setup
+
+def _prepare_database():
+    """Create and upgrade the schema; safe when several workers boot at once."""
+    with db.engine.connect() as conn:
+        # One exclusive transaction: a second worker waits here, then finds nothing left to do
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": _MIGRATION_LOCK_ID})
+        else:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        _create_tables(conn)
+        _upgrade_schema(conn)
+        _seed_id_counter(conn)
+        conn.commit()
+
+def _upgrade_schema(conn):
+    # create_all() won't touch an existing table, so add newer columns and indexes here
+    columns = {c["name"] for c in inspect(conn).get_columns("url_map")}
+    if "long_url_hash" not in columns:
+        col_type = UrlMap.__table__.c.long_url_hash.type.compile(conn.dialect)
+        conn.execute(text(f"ALTER TABLE url_map ADD COLUMN long_url_hash {col_type}"))
+        _backfill_url_hashes(conn)
+    for index in UrlMap.__table__.indexes:
+        conn.execute(CreateIndex(index, if_not_exists=True))
+
+def _backfill_url_hashes(conn):
+    # Hash one generated-code row per URL; custom-code rows keep NULL (see UrlMap.long_url_hash)
+    seen, params = set(), []
+    for r in conn.execute(text("SELECT id, long_url, short_code FROM url_map ORDER BY id")):
+        if r.short_code != encode_base62(r.id):
+            continue  # custom code
+        h = _url_hash(r.long_url)
+        if h not in seen:
+            seen.add(h)
+            params.append({"id": r.id, "h": h})
+    if params:
+        conn.execute(text("UPDATE url_map SET long_url_hash = :h WHERE id = :id"), params)
+
+def _dialect_insert(table):
+    return (pg_insert if db.engine.dialect.name == "postgresql" else sqlite_insert)(table)
+
+def _upsert_url(row_id: int, long_url: str, url_hash: bytes, expires_at: datetime | None):
+    """Insert a generated-code row, or return the existing one for this URL, in one statement."""
+    table = UrlMap.__table__
+    stmt = _dialect_insert(table).values(id=row_id, long_url=long_url, long_url_hash=url_hash,
+                                short_code=encode_base62(row_id), expires_at=expires_at)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.long_url_hash],
+        set_={"expires_at": db.func.coalesce(stmt.excluded.expires_at, table.c.expires_at)},
+    ).returning(table.c.id, table.c.long_url, table.c.short_code, table.c.expires_at)
+    return db.session.execute(stmt).one()
+
+def _create_tables(conn):
+    tables = list(db.metadata.sorted_tables)
+    if conn.dialect.name == "postgresql":
+        tables.remove(IdCounter.__table__)  # ids come from url_map_id_seq there
+    db.metadata.create_all(conn, tables=tables)
+
+def _seed_id_counter(conn):
+    if conn.dialect.name == "postgresql":
+        return
+    # Single statement so workers booting together can't both insert the row
+    start = select(db.func.coalesce(db.func.max(UrlMap.id), 0)).scalar_subquery()
+    conn.execute(
+        sqlite_insert(IdCounter.__table__).values(id=1, n=start).on_conflict_do_nothing(index_elements=["id"])
+    )
+
+_CUSTOM_CODE_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+
+def is_valid_custom_code(code: str) -> bool:
+    return 3 <= len(code) <= 32 and _CUSTOM_CODE_CHARS.issuperset(code)
+
+# Validation only needs "http(s)://<host>"; no need to build a full urlparse() result
+_URL_RE = re.compile(r"https?://[^/\s?#]+", re.IGNORECASE)
+_SCHEME_RE = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*:")
 
 def is_valid_url(url: str) -> bool:
-    try:
-        parsed = urlparse(url)
-        if parsed.scheme not in ("http", "https"):
-            return False
-        if not parsed.netloc:
-            return False
-        return True
-    except Exception:
-        return False
+    return _URL_RE.match(url) is not None
+
+_SHORTEN_FIELDS = ("long_url", "custom_code", "expires_in")
+
+def _read_shorten_form():
+    # The shorten form is tiny and fixed-shape; skip werkzeug's MultiDict parsing for it
+    if request.mimetype == "application/x-www-form-urlencoded":
+        try:
+            return dict(parse_qsl(request.get_data(as_text=True), keep_blank_values=True,
+                                  max_num_fields=len(_SHORTEN_FIELDS)))
+        except ValueError:
+            pass  # extra fields; let werkzeug handle it
+    return request.form
 
 # Base62 encoding
 from base62 import encode_base62
+from hits import HitBuffer
+
+def _database_url() -> str:
+    url = os.getenv("DATABASE_URL", "sqlite:///url_shortener.db")
+    # Point plain postgres URLs at the psycopg 3 driver (its executemany pipelines the hit flushes)
+    for prefix in ("postgres://", "postgresql://"):
+        if url.startswith(prefix):
+            return "postgresql+psycopg://" + url[len(prefix):]
+    return url
+
+def _engine_options(uri: str) -> dict:
+    options = {"pool_pre_ping": True, "pool_recycle": 1800}
+    url = make_url(uri)
+    in_memory = url.get_backend_name() == "sqlite" and (
+        url.database in (None, "", ":memory:") or url.query.get("mode") == "memory")
+    if not in_memory:
+        # In-memory SQLite runs on a StaticPool, which rejects QueuePool sizing arguments
+        options["pool_size"] = int(os.getenv("DB_POOL_SIZE", "20"))
+        options["max_overflow"] = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    return options
 
 def create_app(config: dict | None = None) -> Flask:
     app = Flask(__name__)
     app.config.update(
-        SQLALCHEMY_DATABASE_URI=os.getenv("DATABASE_URL", "sqlite:///url_shortener.db"),
+        SQLALCHEMY_DATABASE_URI=_database_url(),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         SECRET_KEY=os.getenv("SECRET_KEY", "dev-secret-change-me"),
-        PREFERRED_URL_SCHEME=os.getenv("PREFERRED_URL_SCHEME", "http")
+        PREFERRED_URL_SCHEME=os.getenv("PREFERRED_URL_SCHEME", "http"),
+        LOOKUP_CACHE_SIZE=int(os.getenv("LOOKUP_CACHE_SIZE", "100000")),
+        LOOKUP_CACHE_TTL=float(os.getenv("LOOKUP_CACHE_TTL", "60")),
+        HIT_FLUSH_INTERVAL=float(os.getenv("HIT_FLUSH_INTERVAL", "0.5")),
+        QR_MAX_AGE=int(os.getenv("QR_MAX_AGE", str(30 * 24 * 3600))),
     )
     if config:
         app.config.update(config)
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+                          _engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
 
     db.init_app(app)
 
     # Ensure DB exists
     with app.app_context():
-        db.create_all()
+        _prepare_database()
+
+    # Redirects read code -> (long_url, expires_at) from memory. long_url never changes, but
+    # expires_at can be updated by any worker, so entries only live for LOOKUP_CACHE_TTL seconds.
+    # Misses raise inside _load_target and are never cached, so new codes need no invalidation.
+    lookup = cached(TTLCache(maxsize=app.config["LOOKUP_CACHE_SIZE"], ttl=app.config["LOOKUP_CACHE_TTL"]),
+                    key=lambda code: code, lock=threading.Lock(), info=True)(_load_target)
+    app.extensions["url_lookup"] = lookup
+
+    # Redirects only bump an in-memory counter; a background thread writes the deltas
+    hit_stmt = (
+        update(UrlMap.__table__)
+        .where(UrlMap.__table__.c.short_code == bindparam("c"))
+        .values(hits=db.func.coalesce(UrlMap.__table__.c.hits, 0) + bindparam("d"),
+                last_accessed=bindparam("t"))
+    )
+
+    buckets = HitBucket.__table__
+    with app.app_context():
+        bucket_stmt = _dialect_insert(buckets).values(
+            code=bindparam("c"), hour=bindparam("h"), count=bindparam("d"))
+    bucket_stmt = bucket_stmt.on_conflict_do_update(
+        index_elements=[buckets.c.code, buckets.c.hour],
+        set_={"count": buckets.c.count + bucket_stmt.excluded.count},
+    )
+
+    def _write_hits(batch: list[dict]):
+        with app.app_context():
+            db.session.execute(hit_stmt, batch)
+            db.session.execute(bucket_stmt, batch)
+            db.session.commit()
+
+    hit_buffer = HitBuffer(_write_hits, interval=app.config["HIT_FLUSH_INTERVAL"])
+    hit_buffer.start()
+    atexit.register(hit_buffer.stop)
+    app.extensions["hit_buffer"] = hit_buffer
+
+    @app.before_request
+    def _stamp_request():
+        # g lives on the app context, which can outlive a request, so reset it every time
+        g.now = datetime.now(timezone.utc)
 
     # --- Routes ---
     @app.get("/health")
@@ -62,17 +323,18 @@ def create_app(config: dict | None = None) -> Flask:
     @app.get("/")
     def index():
         # Show recent 10 links
-        recent = UrlMap.query.order_by(UrlMap.created_at.desc()).limit(10).all()
+        recent = db.session.execute(_RECENT_STMT).all()
         return render_template("index.html", recent=recent)
 
     @app.post("/shorten")
     def shorten():
-        long_url = request.form.get("long_url", "").strip()
-        custom_code = request.form.get("custom_code", "").strip() or None
-        expires_in_days = request.form.get("expires_in", "").strip()
+        form = _read_shorten_form()
+        long_url = form.get("long_url", "").strip()
+        custom_code = form.get("custom_code", "").strip() or None
+        expires_in_days = form.get("expires_in", "").strip()
 
         # Normalize long_url: if missing scheme, try adding https://
-        if long_url and not urlparse(long_url).scheme:
+        if long_url and not _SCHEME_RE.match(long_url):
             long_url = "https://" + long_url
 
         if not is_valid_url(long_url):
@@ -85,91 +347,125 @@ def create_app(config: dict | None = None) -> Flask:
                 days = int(expires_in_days)
                 if days <= 0:
                     raise ValueError
-                expires_at = datetime.now(timezone.utc) + timedelta(days=days)
+                expires_at = _now() + timedelta(days=days)
             except ValueError:
                 flash("Expiry must be a positive integer number of days.", "danger")
                 return redirect(url_for("index"))
 
         # Validate custom code
         if custom_code:
-            if not re.fullmatch(r"[A-Za-z0-9_-]{3,32}", custom_code):
+            if not is_valid_custom_code(custom_code):
                 flash("Custom code must be 3-32 chars: letters, numbers, _ or - only.", "danger")
                 return redirect(url_for("index"))
             if UrlMap.query.filter_by(short_code=custom_code).first():
                 flash("That short code is already taken. Please choose another.", "danger")
                 return redirect(url_for("index"))
 
-        # Check if the same long_url already exists (reuse to avoid duplicates)
-        existing = UrlMap.query.filter_by(long_url=long_url).first()
-        if existing and not custom_code:
-            # Update expiry if provided
-            if expires_at:
-                existing.expires_at = expires_at
-                db.session.commit()
-            short_url = request.host_url + existing.short_code
-            _ensure_qr_for_code(existing.short_code, request.host_url)
-            return render_template("success.html", short_url=short_url, code=existing.short_code,
-                                   long_url=long_url, expires_at=existing.expires_at)
-
-        # Create the row to get an auto-incrementing ID
-        row = UrlMap(long_url=long_url, expires_at=expires_at)
-        db.session.add(row)
-        db.session.commit()  # to populate row.id
-
-        # Assign short code
-        code = custom_code or encode_base62(row.id)
-        row.short_code = code
+        # Allocate the ID up front so the row is written once with its short code
+        row_id = _next_id()
+        refreshed = False
+        if custom_code:
+            code = custom_code
+            db.session.add(UrlMap(id=row_id, long_url=long_url, short_code=code, expires_at=expires_at))
+        else:
+            # Creates the row, or reuses the existing one for this URL and refreshes its expiry
+            row = _upsert_url(row_id, long_url, _url_hash(long_url), expires_at)
+            if row.long_url != long_url:
+                # blake2b-128 collision with another URL: store this one without a hash
+                code = encode_base62(row_id)
+                db.session.add(UrlMap(id=row_id, long_url=long_url, short_code=code, expires_at=expires_at))
+            else:
+                # Only an expiry sent with this request can have changed the existing row
+                refreshed = row.id != row_id and expires_at is not None
+                code, expires_at = row.short_code, _as_utc(row.expires_at)
         db.session.commit()
+        if refreshed:
+            with lookup.cache_lock:
+                lookup.cache.pop(code, None)
 
-        # Generate QR
-        _ensure_qr_for_code(code, request.host_url)
+        # Render the QR off the request path; /qr/<code>.png covers it if it isn't ready yet
+        host_url = request.host_url
+        qr_pool.submit(_ensure_qr_for_code, code, host_url).add_done_callback(_log_qr_failure)
 
-        short_url = request.host_url + code
+        short_url = host_url + code
         return render_template("success.html", short_url=short_url, code=code,
                                long_url=long_url, expires_at=expires_at)
 
-    def _ensure_qr_for_code(code: str, host_url: str):
-        qr_folder = os.path.join(app.root_path, "static", "qr")
-        os.makedirs(qr_folder, exist_ok=True)
-        short_url = host_url + code
+    qr_folder = os.path.join(app.root_path, "static", "qr")
+    qr_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="qr")
+
+    def _ensure_qr_for_code(code: str, host_url: str) -> str:
         img_path = os.path.join(qr_folder, f"{code}.png")
         if not os.path.exists(img_path):
-            img = qrcode.make(short_url)
-            img.save(img_path)
+            os.makedirs(qr_folder, exist_ok=True)
+            # Write then rename so a concurrent reader never sees a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=qr_folder, prefix=f"{code}.", suffix=".tmp")
+            os.close(fd)
+            try:
+                _render_qr(host_url + code, tmp_path)
+                os.replace(tmp_path, img_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return img_path
+
+    def _log_qr_failure(future):
+        if future.exception() is not None:
+            app.logger.error("Background QR render failed", exc_info=future.exception())
+
+    @app.get("/qr/<string:code>.png")
+    def qr(code: str):
+        try:
+            lookup(code)
+        except KeyError:
+            abort(404)
+        # conditional=True answers repeat fetches with 304 via ETag/Last-Modified
+        return send_file(_ensure_qr_for_code(code, request.host_url), mimetype="image/png",
+                         conditional=True, max_age=app.config["QR_MAX_AGE"])
 
     @app.get("/<string:code>")
     def redirect_code(code: str):
-        item = UrlMap.query.filter_by(short_code=code).first()
-        if not item or item.is_expired():
+        try:
+            long_url, expires_at = lookup(code)
+        except KeyError:
             abort(404)
-        item.hits = (item.hits or 0) + 1
-        item.last_accessed = datetime.now(timezone.utc)
-        db.session.commit()
-        return redirect(item.long_url, code=302)
+        now = _now()
+        if expires_at is not None and now > expires_at:
+            abort(404)
+        hit_buffer.add(code, now)
+        return redirect(long_url, code=302)
 
     @app.get("/stats/<string:code>")
     def stats(code: str):
-        item = UrlMap.query.filter_by(short_code=code).first()
+        item = db.session.execute(_DETAIL_STMT, {"c": code}).first()
         if not item:
             abort(404)
-        return render_template("stats.html", item=item)
+        buckets = db.session.execute(
+            _BUCKETS_STMT, {"c": code, "since": _now() - timedelta(days=7)}).all()
+        return render_template("stats.html", item=item, expired=_is_expired(item.expires_at),
+                               buckets=buckets)
 
     # Simple API for programmatic use
     @app.get("/api/expand/<string:code>")
     def api_expand(code: str):
-        item = UrlMap.query.filter_by(short_code=code).first()
+        item = db.session.execute(_DETAIL_STMT, {"c": code}).first()
         if not item:
-            return jsonify({"error": "not_found"}), 404
-        return jsonify({
+            return _json({"error": "not_found"}, 404)
+        # orjson serialises the datetimes itself (as ISO 8601 with a Z suffix)
+        return _json({
             "code": item.short_code,
             "long_url": item.long_url,
             "hits": item.hits,
-            "created_at": item.created_at.isoformat() if item.created_at else None,
-            "last_accessed": item.last_accessed.isoformat() if item.last_accessed else None,
-            "expires_at": item.expires_at.isoformat() if item.expires_at else None,
-            "expired": item.is_expired(),
+            "created_at": _as_utc(item.created_at),
+            "last_accessed": _as_utc(item.last_accessed),
+            "expires_at": _as_utc(item.expires_at),
+            "expired": _is_expired(item.expires_at),
         })
 
+    def _json(payload: dict, status: int = 200):
+        return app.response_class(orjson.dumps(payload, option=orjson.OPT_UTC_Z),
+                                  status=status, mimetype="application/json")
+
     @app.errorhandler(404)
     def not_found(e):
         return render_template("404.html"), 404
@@ -1,11 +1,39 @@
 ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
-def encode_base62(n: int) -> str:
-    if n == 0:
-        return "0"
-    base = len(ALPHABET)
-    out = []
+_AB = ALPHABET.encode("ascii")
+_MAX_LEN = 11  # 62**11 > 2**63, so any 64-bit id fits
+_LIMIT = 62 ** _MAX_LEN
+
+# Every id below 62**2 precomputed: one tuple index instead of the loop for small services
+_SMALL = tuple(ALPHABET) + tuple(a + b for a in ALPHABET[1:] for b in ALPHABET)
+
+def _py_encode_base62(n: int) -> str:
+    if 0 <= n < 3844:
+        return _SMALL[n]
+    # Fill a fixed buffer from the end instead of building and reversing a list
+    i = _MAX_LEN if n < _LIMIT else n.bit_length() // 5 + 1
+    buf = bytearray(i)
     while n > 0:
-        n, rem = divmod(n, base)
-        out.append(ALPHABET[rem])
-    return "".join(reversed(out))
+        i -= 1
+        n, rem = divmod(n, 62)
+        buf[i] = _AB[rem]
+    return buf[i:].decode("ascii")
+
+def _native_matches(encode) -> bool:
+    # Only take the native encoder if it uses our alphabet; otherwise existing codes would change.
+    # Edge inputs too: it must agree on (not raise for) negatives and ids past 64 bits.
+    samples = (0, 9, 10, 35, 36, 61, 62, 3843, 3844, 2**63 - 1, -1, 2**64, 62**12 + 5)
+    try:
+        return all(encode(n) == _py_encode_base62(n) for n in samples)
+    except Exception:
+        return False
+
+try:
+    from b62 import encode as _native_encode  # optional Rust extension
+except ImportError:
+    _native_encode = None
+
+if _native_encode is not None and _native_matches(_native_encode):
+    encode_base62 = _native_encode
+else:
+    encode_base62 = _py_encode_base62
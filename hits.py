@@ -0,0 +1,66 @@
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from typing import Callable
+
+# Flush callback receives one {"c": code, "h": hour, "d": delta, "t": last_accessed} dict
+# per (code, hour), sorted by (hour, code) so every worker locks rows in the same order
+FlushFn = Callable[[list[dict]], None]
+
+log = logging.getLogger(__name__)
+
+
+class HitBuffer:
+    """Coalesce redirect hits in memory and write them out in batches."""
+
+    def __init__(self, flush: FlushFn, interval: float = 0.5):
+        self._flush = flush
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pending: Counter[tuple[str, datetime]] = Counter()
+        self._last: dict[tuple[str, datetime], datetime] = {}
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def add(self, code: str, now: datetime):
+        key = (code, now.replace(minute=0, second=0, microsecond=0))
+        with self._lock:
+            self._pending[key] += 1
+            self._last[key] = now
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+            last, self._last = self._last, {}
+        if not pending:
+            return
+        try:
+            self._flush([{"c": c, "h": h, "d": pending[c, h], "t": last[c, h]}
+                         for c, h in sorted(pending, key=lambda k: (k[1], k[0]))])
+        except Exception:
+            # Put the counts back so the next flush retries them
+            with self._lock:
+                self._pending.update(pending)
+                for key, t in last.items():
+                    self._last[key] = max(t, self._last.get(key, t))
+            raise
+
+    def start(self):
+        if self._thread is None and self._interval > 0:
+            self._thread = threading.Thread(target=self._run, name="hit-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Failed to flush hit counts; will retry")
@@ -1,7 +1,10 @@
 import os
+import sqlite3
 import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 import pytest
-from app import create_app, db, UrlMap
+from app import create_app, db, UrlMap, HitBucket, IdCounter, is_valid_custom_code, is_valid_url, _render_qr, _database_url, _url_hash
 
 @pytest.fixture()
 def client():
@@ -16,6 +19,7 @@ def client():
         with app.app_context():
             db.create_all()
         yield client
+    app.extensions["hit_buffer"].stop()
     os.close(db_fd)
     os.unlink(db_path)
 
@@ -41,3 +45,252 @@ def test_custom_code_validation(client):
     # good custom code
     resp2 = client.post("/shorten", data={"long_url": "https://example.com/2", "custom_code": "my_code"}, follow_redirects=True)
     assert resp2.status_code == 200
+
+def test_short_codes_follow_allocated_ids(client):
+    client.post("/shorten", data={"long_url": "https://example.com/a"})
+    client.post("/shorten", data={"long_url": "https://example.com/b"})
+    with client.application.app_context():
+        rows = UrlMap.query.order_by(UrlMap.id).all()
+        assert [r.short_code for r in rows] == ["1", "2"]
+        assert [r.id for r in rows] == [1, 2]
+
+def test_redirect_counts_hits_and_skips_expired(client):
+    client.post("/shorten", data={"long_url": "https://example.com/hits"})
+    client.get("/1")
+    client.get("/1")
+    client.application.extensions["hit_buffer"].flush()
+    with client.application.app_context():
+        item = UrlMap.query.filter_by(short_code="1").first()
+        assert item.hits == 2
+        assert item.last_accessed is not None
+    client.post("/shorten", data={"long_url": "https://example.com/old"})
+    with client.application.app_context():
+        item = UrlMap.query.filter_by(short_code="2").first()
+        item.expires_at = datetime.now(timezone.utc) - timedelta(days=1)
+        db.session.commit()
+    assert client.get("/2").status_code == 404
+    assert client.get("/missing").status_code == 404
+
+def test_redirect_lookup_is_cached(client):
+    client.post("/shorten", data={"long_url": "https://example.com/cached"})
+    lookup = client.application.extensions["url_lookup"]
+    client.get("/1")
+    client.get("/1")
+    info = lookup.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    # Unknown codes are not cached, so a later custom code resolves immediately
+    assert client.get("/later").status_code == 404
+    client.post("/shorten", data={"long_url": "https://example.com/later", "custom_code": "later"})
+    assert client.get("/later").status_code == 302
+
+def test_stats_and_api_expand(client):
+    client.post("/shorten", data={"long_url": "https://example.com/info", "expires_in": "3"})
+    assert client.get("/stats/1").status_code == 200
+    data = client.get("/api/expand/1").get_json()
+    assert data["long_url"] == "https://example.com/info"
+    assert data["expired"] is False
+    assert data["expires_at"].endswith("Z")
+    assert data["last_accessed"] is None
+    assert client.get("/api/expand/nope").status_code == 404
+
+def test_is_valid_custom_code():
+    assert is_valid_custom_code("my_code-1")
+    assert is_valid_custom_code("a" * 32)
+    assert not is_valid_custom_code("ab")
+    assert not is_valid_custom_code("a" * 33)
+    assert not is_valid_custom_code("bad code")
+    assert not is_valid_custom_code("café")
+
+def test_same_long_url_reuses_code(client):
+    client.post("/shorten", data={"long_url": "https://example.com/same"})
+    client.post("/shorten", data={"long_url": "https://example.com/same"})
+    with client.application.app_context():
+        rows = UrlMap.query.all()
+        assert len(rows) == 1
+        assert len(rows[0].long_url_hash) == 16
+
+def test_qr_served_on_demand(client):
+    client.post("/shorten", data={"long_url": "https://example.com/qr", "custom_code": "qr_demo"})
+    resp = client.get("/qr/qr_demo.png")
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/png"
+    assert resp.data.startswith(b"\x89PNG")
+    etag = resp.headers["ETag"]
+    resp.close()
+    cached = client.get("/qr/qr_demo.png", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    cached.close()
+    assert client.get("/qr/unknown_code.png").status_code == 404
+
+def test_qr_renderer_refits_per_url(tmp_path):
+    long_path, short_path = tmp_path / "long.png", tmp_path / "short.png"
+    _render_qr("https://example.com/" + "x" * 200, str(long_path))
+    _render_qr("https://example.com/a", str(short_path))
+    assert short_path.stat().st_size < long_path.stat().st_size
+
+def test_is_valid_url():
+    assert is_valid_url("https://example.com/path?q=1")
+    assert is_valid_url("HTTP://example.com")
+    assert not is_valid_url("ftp://example.com")
+    assert not is_valid_url("https://")
+    assert not is_valid_url("https:///path")
+    assert not is_valid_url("example.com")
+
+def test_missing_scheme_defaults_to_https(client):
+    client.post("/shorten", data={"long_url": "example.com/no-scheme"})
+    with client.application.app_context():
+        assert UrlMap.query.first().long_url == "https://example.com/no-scheme"
+
+def test_shorten_accepts_multipart_and_extra_fields(client):
+    client.post("/shorten", data={"long_url": "https://example.com/mp", "custom_code": "multi"},
+                content_type="multipart/form-data")
+    client.post("/shorten", data={"long_url": "https://example.com/extra", "custom_code": "extra",
+                                  "expires_in": "", "csrf_token": "x"})
+    with client.application.app_context():
+        assert UrlMap.query.filter_by(short_code="multi").first().long_url == "https://example.com/mp"
+        assert UrlMap.query.filter_by(short_code="extra").first().long_url == "https://example.com/extra"
+
+def test_postgres_urls_use_psycopg(monkeypatch):
+    monkeypatch.setenv("DATABASE_URL", "postgres://u:p@db/short")
+    assert _database_url() == "postgresql+psycopg://u:p@db/short"
+    monkeypatch.setenv("DATABASE_URL", "postgresql+asyncpg://u:p@db/short")
+    assert _database_url() == "postgresql+asyncpg://u:p@db/short"
+
+def test_reshorten_refreshes_expiry_and_custom_codes_stay_separate(client):
+    client.post("/shorten", data={"long_url": "https://example.com/up"})
+    client.post("/shorten", data={"long_url": "https://example.com/up", "expires_in": "2"})
+    client.post("/shorten", data={"long_url": "https://example.com/up", "custom_code": "up_alias"})
+    with client.application.app_context():
+        generated = UrlMap.query.filter_by(long_url_hash=_url_hash("https://example.com/up")).one()
+        assert generated.short_code == "1"
+        assert generated.expires_at is not None
+        alias = UrlMap.query.filter_by(short_code="up_alias").one()
+        assert alias.long_url_hash is None
+
+def test_hits_are_bucketed_by_hour(client):
+    client.post("/shorten", data={"long_url": "https://example.com/buckets"})
+    for _ in range(3):
+        client.get("/1")
+    client.application.extensions["hit_buffer"].flush()
+    client.get("/1")
+    client.application.extensions["hit_buffer"].flush()
+    with client.application.app_context():
+        buckets = HitBucket.query.filter_by(code="1").all()
+        assert sum(b.count for b in buckets) == 4
+        assert UrlMap.query.filter_by(short_code="1").one().hits == 4
+    resp = client.get("/stats/1")
+    assert b"Clicks in the last week" in resp.data
+    assert b"No clicks yet" not in resp.data
+
+def test_pages_link_with_host_url(client):
+    client.post("/shorten", data={"long_url": "https://example.com/host"})
+    assert b'href="http://localhost/1"' in client.get("/").data
+    assert b'href="http://localhost/1"' in client.get("/stats/1").data
+
+def test_in_memory_sqlite_app():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "HIT_FLUSH_INTERVAL": 0})
+    with app.test_client() as c:
+        assert c.get("/health").status_code == 200
+        assert c.post("/shorten", data={"long_url": "https://example.com/mem"}).status_code == 200
+    assert "pool_size" not in app.config["SQLALCHEMY_ENGINE_OPTIONS"]
+
+def test_cached_expiry_is_time_bounded(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'ttl.db'}",
+                      "HIT_FLUSH_INTERVAL": 0, "LOOKUP_CACHE_TTL": 0.2})
+    with app.test_client() as c:
+        c.post("/shorten", data={"long_url": "https://example.com/ttl"})
+        assert c.get("/1").status_code == 302
+        # Another worker sets an expiry in the past behind this process's cache
+        with app.app_context():
+            UrlMap.query.filter_by(short_code="1").one().expires_at = datetime.now(timezone.utc) - timedelta(days=1)
+            db.session.commit()
+        time.sleep(0.3)
+        assert c.get("/1").status_code == 404
+
+def test_reshorten_only_evicts_the_refreshed_code(client):
+    client.post("/shorten", data={"long_url": "https://example.com/keep"})
+    client.post("/shorten", data={"long_url": "https://example.com/exp", "expires_in": "5"})
+    client.get("/1")
+    client.get("/2")
+    lookup = client.application.extensions["url_lookup"]
+    assert lookup.cache_info().currsize == 2
+    # No expiry sent: nothing changes, nothing is evicted
+    client.post("/shorten", data={"long_url": "https://example.com/exp"})
+    assert lookup.cache_info().currsize == 2
+    # New expiry: only that code is dropped
+    client.post("/shorten", data={"long_url": "https://example.com/exp", "expires_in": "9"})
+    assert "1" in lookup.cache and "2" not in lookup.cache
+
+def test_stats_only_shows_last_week_of_buckets(client):
+    client.post("/shorten", data={"long_url": "https://example.com/sparse"})
+    hour = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    old, recent = hour - timedelta(days=40), hour - timedelta(days=2)
+    with client.application.app_context():
+        db.session.add_all([HitBucket(code="1", hour=old, count=7), HitBucket(code="1", hour=recent, count=3)])
+        db.session.commit()
+    page = client.get("/stats/1").data.decode()
+    assert recent.strftime("%Y-%m-%d %H:00") in page
+    assert old.strftime("%Y-%m-%d %H:00") not in page
+
+def test_each_request_gets_its_own_timestamp(client):
+    with client.application.app_context():
+        client.post("/shorten", data={"long_url": "https://example.com/t1"})
+        time.sleep(0.01)
+        client.post("/shorten", data={"long_url": "https://example.com/t2"})
+        first, second = UrlMap.query.order_by(UrlMap.id).all()
+        assert second.created_at > first.created_at
+
+def test_host_url_follows_each_request(client):
+    client.post("/shorten", data={"long_url": "https://example.com/hosts"})
+    app = client.application
+    plain = app.test_client()  # no context preservation, so requests share the app context below
+    with app.app_context():
+        assert b'href="http://localhost/1"' in plain.get("/").data
+        assert b'href="http://other.example/1"' in plain.get("/", base_url="http://other.example").data
+
+def test_background_qr_failures_are_logged(client, monkeypatch, caplog):
+    def boom(data, path):
+        raise OSError("disk full")
+    monkeypatch.setattr("app._render_qr", boom)
+    client.post("/shorten", data={"long_url": "https://example.com/qrfail", "custom_code": "qr_fail"})
+    deadline = time.time() + 2
+    while "Background QR render failed" not in caplog.text and time.time() < deadline:
+        time.sleep(0.01)
+    assert "disk full" in caplog.text
+    qr_dir = os.path.join(client.application.root_path, "static", "qr")
+    assert not [f for f in os.listdir(qr_dir) if f.startswith("qr_fail.")]
+
+def test_id_counter_seed_is_idempotent(tmp_path):
+    uri = f"sqlite:///{tmp_path / 'seed.db'}"
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "HIT_FLUSH_INTERVAL": 0})
+    with app.test_client() as c:
+        c.post("/shorten", data={"long_url": "https://example.com/seed"})
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "HIT_FLUSH_INTERVAL": 0})
+    with app.app_context():
+        assert IdCounter.query.count() == 1
+        assert IdCounter.query.one().n == 1
+
+def _make_legacy_db(path):
+    # Schema as shipped before long_url_hash, hit_bucket and id_counter existed
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE url_map (id INTEGER PRIMARY KEY, long_url TEXT NOT NULL, "
+                 "short_code VARCHAR(32) UNIQUE, created_at DATETIME, hits INTEGER, "
+                 "last_accessed DATETIME, expires_at DATETIME)")
+    conn.execute("CREATE INDEX ix_url_map_short_code ON url_map (short_code)")
+    conn.execute("INSERT INTO url_map (id, long_url, short_code, hits) VALUES (7, 'https://old.example', '7', 0)")
+    conn.commit()
+    conn.close()
+
+def test_upgrade_of_legacy_db_is_repeatable(tmp_path):
+    path = tmp_path / "legacy.db"
+    _make_legacy_db(path)
+    config = {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{path}", "HIT_FLUSH_INTERVAL": 0}
+    create_app(config)
+    app = create_app(config)
+    with app.test_client() as c:
+        assert b'value="http://localhost/7"' in c.post("/shorten", data={"long_url": "https://old.example"}).data
+        c.post("/shorten", data={"long_url": "https://new.example"})
+    with app.app_context():
+        assert UrlMap.query.filter_by(short_code="7").one().long_url_hash == _url_hash("https://old.example")
+        assert UrlMap.query.filter_by(long_url="https://new.example").one().id > 7
+        assert IdCounter.query.count() == 1
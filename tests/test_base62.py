@@ -0,0 +1,66 @@
+import importlib
+import sys
+import types
+import pytest
+import base62
+from base62 import ALPHABET, _py_encode_base62, encode_base62
+
+def _decode(s: str) -> int:
+    n = 0
+    for ch in s:
+        n = n * 62 + ALPHABET.index(ch)
+    return n
+
+def test_known_values():
+    assert encode_base62(0) == "0"
+    assert encode_base62(61) == "Z"
+    assert encode_base62(62) == "10"
+    assert encode_base62(3843) == "ZZ"
+    assert encode_base62(3844) == "100"
+
+def test_matches_reference_and_round_trips():
+    for n in list(range(5000)) + [10**9, 2**53, 2**63 - 1]:
+        assert encode_base62(n) == _py_encode_base62(n)
+        assert _decode(encode_base62(n)) == n
+
+def test_ids_beyond_64_bits():
+    n = 62 ** 12 + 5
+    assert _decode(encode_base62(n)) == n
+
+def test_negative_ids_encode_to_empty_string():
+    assert encode_base62(-5) == ""
+
+@pytest.fixture()
+def reload_with_b62(monkeypatch):
+    def load(encode):
+        monkeypatch.setitem(sys.modules, "b62", types.SimpleNamespace(encode=encode))
+        return importlib.reload(base62)
+    yield load
+    monkeypatch.delitem(sys.modules, "b62", raising=False)
+    importlib.reload(base62)
+
+def test_matching_native_encoder_is_used(reload_with_b62):
+    def native(n):
+        return base62._py_encode_base62(n)
+    assert reload_with_b62(native).encode_base62 is native
+
+def test_native_encoder_with_other_alphabet_falls_back(reload_with_b62):
+    other = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    def native(n):
+        return base62._py_encode_base62(n).translate(str.maketrans(ALPHABET, other))
+    mod = reload_with_b62(native)
+    assert mod.encode_base62 is mod._py_encode_base62
+
+def test_raising_native_encoder_falls_back(reload_with_b62):
+    def native(n):
+        raise OverflowError
+    mod = reload_with_b62(native)
+    assert mod.encode_base62 is mod._py_encode_base62
+
+def test_native_encoder_failing_on_edge_ids_falls_back(reload_with_b62):
+    def native(n):
+        if not 0 <= n < 2**63:
+            raise OverflowError(n)
+        return base62._py_encode_base62(n)
+    mod = reload_with_b62(native)
+    assert mod.encode_base62 is mod._py_encode_base62
@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta, timezone
+from hits import HitBuffer
+
+def test_flush_orders_batch_by_hour_then_code():
+    batches = []
+    buf = HitBuffer(batches.append, interval=0)
+    t = datetime(2026, 1, 1, 10, 30, tzinfo=timezone.utc)
+    for code, when in [("zz", t), ("aa", t), ("mm", t + timedelta(hours=1)), ("bb", t), ("aa", t)]:
+        buf.add(code, when)
+    buf.flush()
+    (batch,) = batches
+    assert [(r["c"], r["h"].hour) for r in batch] == [("aa", 10), ("bb", 10), ("zz", 10), ("mm", 11)]
+    assert batch[0]["d"] == 2
+
+def test_failed_flush_requeues_counts():
+    calls = []
+    def flaky(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise RuntimeError("db down")
+    buf = HitBuffer(flaky, interval=0)
+    buf.add("aa", datetime(2026, 1, 1, tzinfo=timezone.utc))
+    try:
+        buf.flush()
+    except RuntimeError:
+        pass
+    buf.flush()
+    assert calls[1][0]["d"] == 1